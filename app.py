@@ -1,23 +1,37 @@
 import os
+import sys
+import mmap
+import fcntl
 import json
 import random
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, g, send_from_directory
 from collections import Counter
 import datetime
 import requests
 import itertools
+import numpy as np
+import math
+import struct
+import hashlib
+import hmac
+import threading
+import time
 
 # Firebase Admin SDK imports
 import firebase_admin
 from firebase_admin import credentials
 from firebase_admin import firestore
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 # Flask 앱 초기화
 app = Flask(__name__)
+# Render 프록시가 덧붙인 X-Forwarded-For 마지막 값(실제 클라이언트 IP)을 request.remote_addr로 사용
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
 
 # Firebase Firestore 클라이언트 선언 (초기화는 아래 함수에서 수행)
 db = None
 app_id = os.environ.get('RENDER_EXTERNAL_HOSTNAME', 'default-smartpick-app').replace('.', '-')
+ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', '1234') # 관리자 페이지 인증 (운영 환경에서는 환경 변수로 설정)
 
 def initialize_firebase_app():
     """Firebase Admin SDK를 초기화하고 Firestore 클라이언트를 반환합니다."""
@@ -148,10 +162,160 @@ ALL_WINNING = {
     "3": set(rank3)
 }
 
+# --- 발급 번호 아카이브 (회차별 당첨 집계용) ---
+# /, /filter, /hotpick에서 발급한 번호를 45비트 비트마스크(uint64, 8바이트)로 발급 시점의 판매 회차 파일
+# round_{회차}.bin에 append합니다. 회차는 관리자가 update_winning을 실행한 시점이 아니라 판매 마감 시각
+# (매주 토요일 20:00 KST)으로 정하므로, 추첨 후~반영 전에 발급된 번호는 다음 회차로 기록됩니다.
+# 요청 1건당 write 1회이며, O_APPEND로 여러 gunicorn 프로세스가 같은 파일에 안전하게 기록합니다.
+# update_winning에서 새 회차가 반영되면 해당 회차 파일의 등수별 당첨 수를 집계합니다.
+ARCHIVE_DIR = os.path.join(BASE_DIR, 'ticket_archive')
+KST = datetime.timezone(datetime.timedelta(hours=9))
+LOTTO_FIRST_CUTOFF = datetime.datetime(2002, 12, 7, 20, 0, tzinfo=KST) # 1회 판매 마감 (이후 매주 1회차씩 증가)
+
+# Function to get the round currently on sale (the next draw whose sales cutoff has not passed)
+def current_sales_round(now=None):
+    now = now or datetime.datetime.now(KST)
+    return (now - LOTTO_FIRST_CUTOFF) // datetime.timedelta(weeks=1) + 2
+
+# Function to get the archive file path of a round
+def round_archive_path(drw_no):
+    return os.path.join(ARCHIVE_DIR, f'round_{drw_no}.bin')
+
+# Function to convert a 6-number ticket into a 45-bit mask (bit n-1 for number n)
+def ticket_to_mask(numbers):
+    mask = 0
+    for n in numbers:
+        mask |= 1 << (n - 1)
+    return mask
+
+# Function to append issued tickets to the archive of the round currently on sale
+def archive_tickets(tickets):
+    if not tickets:
+        return
+    try:
+        data = np.array([ticket_to_mask(t) for t in tickets], dtype='<u8').tobytes()
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        fd = os.open(round_archive_path(current_sales_round()), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+    except Exception as e:
+        print(f"발급 번호 아카이브 기록 오류: {e}")
+
+# Function to count 1st~5th rank winners among archived masks
+def tally_tickets(masks, nums, bonus):
+    win_mask = np.uint64(ticket_to_mask(nums))
+    bonus_mask = np.uint64(1 << (bonus - 1))
+    matches = np.bitwise_count(masks & win_mask)
+    has_bonus = (masks & bonus_mask) != 0
+    return {
+        "1": int(np.count_nonzero(matches == 6)),
+        "2": int(np.count_nonzero((matches == 5) & has_bonus)),
+        "3": int(np.count_nonzero((matches == 5) & ~has_bonus)),
+        "4": int(np.count_nonzero(matches == 4)),
+        "5": int(np.count_nonzero(matches == 3)),
+        "total": int(masks.size)
+    }
+
+# Function to tally the wins of round `drw_no` from its archive
+# 회차 파일은 판매 마감 이후 더 이상 추가되지 않으므로, 같은 회차를 다시 반영해도 결과가 같습니다.
+def close_round_archive(drw_no, nums, bonus):
+    round_path = round_archive_path(drw_no)
+    if not os.path.exists(round_path):
+        return None
+    with open(round_path, "rb") as f:
+        data = f.read()
+    masks = np.frombuffer(data[:len(data) - len(data) % 8], dtype='<u8') # 부분 기록된 꼬리 바이트는 무시
+    tally = tally_tickets(masks, nums, bonus)
+    with open(os.path.join(ARCHIVE_DIR, f'round_{drw_no}_tally.json'), "w", encoding="utf-8") as f:
+        json.dump({"round": drw_no, "numbers": nums, "bonus": bonus, "tally": tally}, f, ensure_ascii=False, indent=2)
+    return tally
+
+# --- 전역 중복 방지 (회차 내 발급 번호 비트맵) ---
+# GLOBAL_UNIQUE_TICKETS=1이면 현재 회차에 발급된 모든 조합을 조합 순위(0 ~ C(45,6)-1)로 인덱싱한
+# 약 1MB 비트맵 파일에 기록하고, 이미 발급된 조합은 O(1)로 건너뜁니다.
+# /, /filter, /hotpick 모두 발급된 조합을 건너뜁니다. 단, /hotpick uniform 모드에서 인기 번호 풀의 조합 수가
+# HOT_PICK_UNIQUE_MIN_COMBOS 미만이면(예: 최근 1주 = 1조합) 중복을 피할 수 없으므로 거절 없이 기록만 합니다.
+# 비트맵은 MAP_SHARED mmap으로 모든 gunicorn 프로세스가 공유하며, 비트 설정은 flock으로 직렬화합니다.
+# update_winning에서 새 회차가 반영되면 0으로 초기화됩니다.
+GLOBAL_UNIQUE_TICKETS = os.environ.get('GLOBAL_UNIQUE_TICKETS', '0') == '1'
+HOT_PICK_UNIQUE_MIN_COMBOS = 1000 # 이보다 조합 수가 적은 인기 번호 풀은 전역 중복 방지 대상에서 제외
+HOT_PICK_UNIQUE_MAX_TRIES = 1000 # 인기 번호 추천 1세트당 미발급 조합을 찾는 최대 재추첨 횟수
+ISSUED_BITMAP_PATH = os.path.join(ARCHIVE_DIR, 'issued_bitmap.bin')
+ISSUED_BITMAP_SIZE = (math.comb(45, 6) + 7) // 8 # 8,145,060비트 = 1,018,133바이트
+COMB_TABLE = [[math.comb(n, k) for k in range(7)] for n in range(46)]
+
+issued_bitmap = None # (pid, fd, mmap) - fork 이후 프로세스마다 새로 엽니다 (flock은 fd 단위)
+issued_bitmap_lock = threading.Lock() # 같은 프로세스 내 스레드 간 직렬화
+
+# Function to compute the colex combinatorial rank of a sorted 6-number ticket
+def ticket_rank(numbers):
+    return sum(COMB_TABLE[n - 1][i + 1] for i, n in enumerate(sorted(numbers)))
+
+# Function to open (once per process) the shared issued-ticket bitmap
+def get_issued_bitmap():
+    global issued_bitmap
+    if issued_bitmap is None or issued_bitmap[0] != os.getpid():
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        fd = os.open(ISSUED_BITMAP_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(fd).st_size < ISSUED_BITMAP_SIZE:
+            os.ftruncate(fd, ISSUED_BITMAP_SIZE)
+        issued_bitmap = (os.getpid(), fd, mmap.mmap(fd, ISSUED_BITMAP_SIZE, mmap.MAP_SHARED))
+    return issued_bitmap
+
+# Function to atomically mark a ticket as issued; returns False if it was already issued
+def claim_ticket(numbers):
+    _, fd, bitmap = get_issued_bitmap()
+    rank = ticket_rank(numbers)
+    byte_idx, bit = rank >> 3, 1 << (rank & 7)
+    if bitmap[byte_idx] & bit: # 잠금 없이 먼저 확인 (이미 발급된 경우 빠르게 거절)
+        return False
+    with issued_bitmap_lock:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if bitmap[byte_idx] & bit:
+                return False
+            bitmap[byte_idx] |= bit
+            return True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+# Function to redraw until a ticket not yet issued this round is claimed; returns None after max_tries
+def draw_unique_ticket(draw, max_tries=HOT_PICK_UNIQUE_MAX_TRIES):
+    for _ in range(max_tries):
+        ticket = draw()
+        try:
+            if claim_ticket(ticket):
+                return ticket
+        except OSError as e:
+            print(f"발급 번호 비트맵 사용 불가, 전역 중복 방지 없이 생성합니다: {e}")
+            return ticket
+    return None
+
+# Function to record tickets issued without the no-repeat check (small /hotpick uniform pools)
+def mark_tickets_issued(tickets):
+    try:
+        for t in tickets:
+            claim_ticket(t)
+    except OSError as e:
+        print(f"발급 번호 비트맵 기록 오류: {e}")
+
+# Function to clear the issued-ticket bitmap when a new round starts
+def reset_issued_tickets():
+    _, fd, bitmap = get_issued_bitmap()
+    with issued_bitmap_lock:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            bitmap[:] = bytes(ISSUED_BITMAP_SIZE)
+            bitmap.flush()
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
 # Function to get frequently appearing numbers from recent N draws
 def get_hot_numbers(n=5):
     all_nums = []
-    for row in rank1[-n:]:
+    for row in rank1[:n]: # rank1은 최신 회차가 앞에 오도록 저장됨
         all_nums.extend(row)
     
     freq = {}
@@ -161,6 +325,82 @@ def get_hot_numbers(n=5):
     sorted_nums = [k for k, v in sorted(freq.items(), key=lambda x: -x[1])]
     return set(sorted_nums)
 
+# --- 가중치 기반 인기 번호 추첨 (alias table) ---
+# (window, mode)별 추첨 테이블(uniform은 인기 번호 목록, freq/decay는 alias 테이블)을 미리 만들어 두고,
+# 새 회차가 반영될 때(update_winning)만 비웁니다. window=None이면 전체 회차를 사용합니다.
+HOT_PICK_MODES = ("uniform", "freq", "decay")
+HOT_PICK_DECAY = 0.85 # decay 모드에서 한 회차 이전마다 곱해지는 가중치
+HOT_PICK_FLOOR = 0.1 # 구간 내 미출현 번호에 주는 가중치 (최대 가중치 대비 비율)
+hot_pick_tables = {} # (window, mode) -> 번호 목록 또는 (numbers, prob, alias)
+hot_pick_tables_lock = threading.Lock()
+
+# Function to compute per-number weights over the recent `window` draws
+def get_hot_weights(window=None, mode="freq"):
+    rows = rank1[:window] if window else rank1 # rank1은 최신 회차가 앞에 오도록 저장됨
+    weights = {n: 0.0 for n in range(1, 46)}
+    for age, row in enumerate(rows):
+        w = HOT_PICK_DECAY ** age if mode == "decay" else 1.0
+        for num in row:
+            weights[num] += w
+    
+    # 구간에 나오지 않은 번호에도 작은 가중치를 주어, 짧은 구간에서도 매번 같은 조합만 나오지 않게 합니다.
+    floor = max(weights.values()) * HOT_PICK_FLOOR or 1.0
+    for n in weights:
+        if weights[n] == 0:
+            weights[n] = floor
+    return weights
+
+# Function to build a Walker/Vose alias table from a weight dict
+def build_alias_table(weights):
+    numbers = list(weights.keys())
+    size = len(numbers)
+    total = sum(weights.values())
+    scaled = [weights[n] * size / total for n in numbers]
+    prob = [0.0] * size
+    alias = [0] * size
+    small = [i for i, p in enumerate(scaled) if p < 1.0]
+    large = [i for i, p in enumerate(scaled) if p >= 1.0]
+    while small and large:
+        s_idx = small.pop()
+        l_idx = large.pop()
+        prob[s_idx] = scaled[s_idx]
+        alias[s_idx] = l_idx
+        scaled[l_idx] -= 1.0 - scaled[s_idx]
+        if scaled[l_idx] < 1.0:
+            small.append(l_idx)
+        else:
+            large.append(l_idx)
+    for i in large + small: # 부동소수점 오차로 남은 항목은 확률 1로 처리
+        prob[i] = 1.0
+    return numbers, prob, alias
+
+# Function to get (and cache) the hot-pick table for a window/mode
+def get_hot_pick_table(window=None, mode="freq"):
+    key = (window, mode)
+    table = hot_pick_tables.get(key)
+    if table is None:
+        with hot_pick_tables_lock:
+            table = hot_pick_tables.get(key)
+            if table is None:
+                if mode == "uniform":
+                    table = sorted(get_hot_numbers(window or len(rank1)))
+                else:
+                    table = build_alias_table(get_hot_weights(window, mode))
+                hot_pick_tables[key] = table
+    return table
+
+# Function to draw one 6-number set proportional to the alias table weights (O(1) per number)
+def weighted_hot_pick(table):
+    numbers, prob, alias = table
+    size = len(numbers)
+    picked = set()
+    while len(picked) < 6:
+        i = random.randrange(size)
+        if random.random() >= prob[i]:
+            i = alias[i]
+        picked.add(numbers[i])
+    return sorted(picked)
+
 # Function to check if a set of numbers contains a consecutive sequence
 def has_consecutive(numbers, seq_len=2):
     nums = sorted(list(numbers))
@@ -181,7 +421,8 @@ def generate_numbers(
     exclude_consecutive=None,
     user_exclude=None,
     user_include=None,
-    count=1
+    count=1,
+    unique_global=False
 ):
     results = []
     tries = 0
@@ -245,6 +486,20 @@ def generate_numbers(
             if tries > 30000: break
             continue
             
+        # 7. Skip tickets already issued to anyone in this round (global no-repeat mode)
+        if unique_global:
+            try:
+                claimed = claim_ticket(nums)
+            except OSError as e:
+                # 비트맵 파일을 쓸 수 없으면(권한, 디스크 부족 등) 전역 중복 방지 없이 계속 생성
+                print(f"발급 번호 비트맵 사용 불가, 전역 중복 방지 없이 생성합니다: {e}")
+                unique_global = False
+                claimed = True
+            if not claimed:
+                tries += 1
+                if tries > 30000: break
+                continue
+            
         results.append(sorted(list(nums)))
         # Do NOT increment tries for successful generation, only for rejected tries
         # This allows it to generate 'count' numbers without hitting max_tries too soon if filters are strict
@@ -260,6 +515,250 @@ def parse_int_list(text):
         return []
     return [int(n) for n in str(text).replace(" ", "").split(",") if str(n).isdigit()]
 
+# --- 생성 요청 승인 제어 (Admission control) ---
+# 무거운 필터 조합이나 큰 count 요청이 워커를 오래 붙잡지 않도록,
+# 실행 전에 비용을 추정하고 클라이언트별 토큰 버킷과 전역 동시 실행 한도를 적용합니다.
+# 슬롯(flock 잠금 파일)과 버킷(mmap 공유 테이블)은 admission/ 디렉터리의 파일로 모든 gunicorn 프로세스가 공유합니다.
+# sync 워커에서는 슬롯을 기다리는 동안에도 워커가 점유되므로 대기 시간은 짧게 유지합니다.
+GENERATION_MAX_COUNT = int(os.environ.get('GENERATION_MAX_COUNT', 10)) # 한 번에 요청 가능한 최대 추천 개수
+GENERATION_MAX_TRIES = 30000 # generate_numbers의 거절 시도 상한과 동일
+GENERATION_CONCURRENCY = int(os.environ.get('GENERATION_CONCURRENCY', 2)) # 동시에 실행 가능한 생성 요청 수
+GENERATION_QUEUE_TIMEOUT = float(os.environ.get('GENERATION_QUEUE_TIMEOUT', 0.5)) # 슬롯 대기 최대 시간(초)
+CLIENT_BUCKET_CAPACITY = float(os.environ.get('CLIENT_BUCKET_CAPACITY', 20000)) # 클라이언트별 최대 비용 토큰
+CLIENT_BUCKET_REFILL = float(os.environ.get('CLIENT_BUCKET_REFILL', 500)) # 초당 충전되는 비용 토큰
+CLIENT_BUCKET_SETS = 2048 # 공유 버킷 테이블의 세트 수 (세트당 CLIENT_BUCKET_WAYS개 버킷, 최대 8192 클라이언트)
+CLIENT_BUCKET_WAYS = 4
+CLIENT_BUCKET_ENTRY = struct.Struct('<Qdd') # (클라이언트 키 해시, 토큰, 마지막 충전 시각)
+ADMISSION_DIR = os.path.join(BASE_DIR, 'admission')
+CLIENT_BUCKETS_PATH = os.path.join(ADMISSION_DIR, 'client_buckets.bin')
+CLIENT_BUCKETS_SIZE = CLIENT_BUCKET_SETS * CLIENT_BUCKET_WAYS * CLIENT_BUCKET_ENTRY.size
+
+client_buckets = None # (pid, fd, mmap) - fork 이후 프로세스마다 새로 엽니다 (flock은 fd 단위)
+client_buckets_lock = threading.Lock() # 같은 프로세스 내 스레드 간 직렬화
+
+# Function to estimate the cost of a generate_numbers call (in rejection-loop iterations)
+def estimate_generation_cost(
+    count=1,
+    exclude_ranks=None,
+    exclude_hot_n=None,
+    exclude_consecutive=None,
+    user_exclude=None,
+    user_include=None
+):
+    total = math.comb(45, 6)
+    # 한 번의 무작위 추출이 필터를 통과할 확률(근사치)
+    blocked = set(user_exclude or [])
+    if exclude_hot_n:
+        blocked.update(get_hot_numbers(exclude_hot_n))
+    required = set(user_include or []) - blocked
+    if set(user_include or []) & blocked:
+        return None # 고정 번호가 제외 번호에 포함되면 조건을 만족하는 조합이 없음
+    free_pool = 45 - len(blocked) - len(required)
+    need = 6 - len(required)
+    if need < 0 or free_pool < need:
+        return None
+    accept = math.comb(free_pool, need) / total
+    if exclude_consecutive == 2:
+        # 2연속 제외: 45개 중 서로 인접하지 않은 6개를 고를 확률
+        accept *= math.comb(40, 6) / total
+    elif exclude_consecutive:
+        accept *= 0.9
+    if accept <= 0:
+        return None
+
+    # 1~3등 제외 시 시도마다 5개 조합 6개를 검사하므로 가중치를 둡니다.
+    per_try = 7 if exclude_ranks else 1
+    tries = min(count / accept, GENERATION_MAX_TRIES + count)
+    return int(math.ceil(tries * per_try))
+
+# Function to identify the requesting client (ProxyFix가 프록시가 덧붙인 IP로 remote_addr를 설정)
+def get_client_key():
+    return request.remote_addr or 'unknown'
+
+# Function to open (once per process) the shared client bucket table
+def get_client_buckets():
+    global client_buckets
+    if client_buckets is None or client_buckets[0] != os.getpid():
+        os.makedirs(ADMISSION_DIR, exist_ok=True)
+        fd = os.open(CLIENT_BUCKETS_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(fd).st_size < CLIENT_BUCKETS_SIZE:
+            os.ftruncate(fd, CLIENT_BUCKETS_SIZE)
+        client_buckets = (os.getpid(), fd, mmap.mmap(fd, CLIENT_BUCKETS_SIZE, mmap.MAP_SHARED))
+    return client_buckets
+
+# Function to take `cost` tokens from the client's bucket; returns seconds to wait when short
+def take_client_tokens(client_key, cost):
+    # 0은 빈 버킷을 뜻하므로 해시가 0이면 1로 바꿉니다. (hash()는 프로세스마다 달라 blake2b 사용)
+    key_hash = int.from_bytes(hashlib.blake2b(client_key.encode(), digest_size=8).digest(), 'little') or 1
+    base = (key_hash % CLIENT_BUCKET_SETS) * CLIENT_BUCKET_WAYS
+    cost = min(cost, CLIENT_BUCKET_CAPACITY)
+    now = time.time()
+    _, fd, buckets = get_client_buckets()
+    with client_buckets_lock:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            entries = [CLIENT_BUCKET_ENTRY.unpack_from(buckets, (base + w) * CLIENT_BUCKET_ENTRY.size) for w in range(CLIENT_BUCKET_WAYS)]
+            way = next((w for w, entry in enumerate(entries) if entry[0] == key_hash), None)
+            if way is None:
+                # 새 클라이언트는 세트에서 가장 오래 갱신되지 않은 버킷(LRU)을 교체
+                way = min(range(CLIENT_BUCKET_WAYS), key=lambda w: entries[w][2])
+                tokens, last = CLIENT_BUCKET_CAPACITY, now
+            else:
+                _, tokens, last = entries[way]
+            tokens = min(CLIENT_BUCKET_CAPACITY, tokens + max(0.0, now - last) * CLIENT_BUCKET_REFILL)
+            wait = 0
+            if tokens < cost:
+                wait = (cost - tokens) / CLIENT_BUCKET_REFILL
+            else:
+                tokens -= cost
+            CLIENT_BUCKET_ENTRY.pack_into(buckets, (base + way) * CLIENT_BUCKET_ENTRY.size, key_hash, tokens, now)
+            return wait
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+# Function to acquire one of the shared generation slots; returns the locked fd, or None on timeout
+def acquire_generation_slot(timeout=GENERATION_QUEUE_TIMEOUT):
+    os.makedirs(ADMISSION_DIR, exist_ok=True)
+    deadline = time.monotonic() + timeout
+    while True:
+        for i in range(GENERATION_CONCURRENCY):
+            # 매번 새로 열어야 같은 프로세스의 다른 스레드와도 잠금이 구분됩니다.
+            fd = os.open(os.path.join(ADMISSION_DIR, f'slot_{i}.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(0.05)
+
+# Function to release a generation slot (fd를 닫으면 flock이 해제됩니다)
+def release_generation_slot(slot):
+    os.close(slot)
+
+# Function to admit a generation request; returns (admitted, error, status, retry_after, slot)
+# hold_slot=True로 승인된 경우 호출자는 작업 후 반드시 release_generation_slot(slot)을 호출해야 합니다.
+def admit_generation(cost, hold_slot=True):
+    slot = None
+    if hold_slot:
+        # 슬롯을 먼저 확보해 실행되지 않은 요청에 토큰이 차감되지 않도록 합니다.
+        slot = acquire_generation_slot()
+        if slot is None:
+            return False, "현재 추천 요청이 많아 처리할 수 없습니다. 잠시 후 다시 시도해주세요.", 503, 5, None
+    wait = take_client_tokens(get_client_key(), cost)
+    if wait > 0:
+        if slot is not None:
+            release_generation_slot(slot)
+        retry_after = int(math.ceil(wait))
+        return False, f"요청이 너무 많습니다. {retry_after}초 후 다시 시도해주세요.", 429, retry_after, None
+    return True, "", 200, 0, slot
+
+# --- 요청 단위 온디맨드 프로파일링 ---
+# 프로파일 헤더(X-SmartPick-Profile: PROFILE_TOKEN)가 있거나 PROFILE_SAMPLE_N 요청 중 1건을 골라,
+# 해당 요청 스레드의 콜스택을 주기적으로 샘플링하고 flamegraph.pl/speedscope에서 읽을 수 있는
+# collapsed stack 형식(.folded)으로 profiles/ 디렉터리에 최근 PROFILE_MAX_FILES개만 보관합니다.
+# 프로파일 대상이 아닌 요청은 헤더 조회 한 번 외에 아무 작업도 하지 않습니다.
+PROFILE_HEADER = 'X-SmartPick-Profile'
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '') # 비어 있으면 헤더를 통한 프로파일링 비활성화
+PROFILE_SAMPLE_N = int(os.environ.get('PROFILE_SAMPLE_N', 0)) # 0이면 샘플링 비활성화
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.002)) # 스택 샘플링 주기(초)
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', 50))
+PROFILE_DIR = os.path.join(BASE_DIR, 'profiles')
+
+profile_request_counter = itertools.count(1)
+profile_write_lock = threading.Lock()
+
+# Background sampler that records the call stack of one request thread
+class StackSampler(threading.Thread):
+    def __init__(self, target_ident, interval):
+        super().__init__(daemon=True)
+        self.target_ident = target_ident
+        self.interval = interval
+        self.stacks = Counter()
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.target_ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+# Function to decide whether the current request should be profiled
+def should_profile_request():
+    if PROFILE_TOKEN:
+        token = request.headers.get(PROFILE_HEADER)
+        if token and hmac.compare_digest(token, PROFILE_TOKEN):
+            return True
+    return PROFILE_SAMPLE_N > 0 and next(profile_request_counter) % PROFILE_SAMPLE_N == 0
+
+# Function to write a profile into the on-disk ring, dropping the oldest files beyond the limit
+def save_profile(endpoint, duration_ms, stacks):
+    filename = f"{int(time.time() * 1000)}_{endpoint}_{duration_ms}.folded"
+    with profile_write_lock:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(os.path.join(PROFILE_DIR, filename), "w", encoding="utf-8") as f:
+            for stack, samples in stacks.items():
+                f.write(f"{stack} {samples}\n")
+        files = sorted(name for name in os.listdir(PROFILE_DIR) if name.endswith(".folded"))
+        for old in files[:-PROFILE_MAX_FILES]:
+            try:
+                os.remove(os.path.join(PROFILE_DIR, old))
+            except OSError as e:
+                print(f"오래된 프로파일 삭제 오류: {e}")
+
+# Function to list stored profiles (newest first) for the admin page
+def list_profiles():
+    try:
+        files = sorted((name for name in os.listdir(PROFILE_DIR) if name.endswith(".folded")), reverse=True)
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for name in files:
+        try:
+            ts, rest = name[:-len(".folded")].split("_", 1)
+            endpoint, duration_ms = rest.rsplit("_", 1)
+            profiles.append({
+                "file": name,
+                "dt": datetime.datetime.fromtimestamp(int(ts) / 1000).strftime('%Y-%m-%d %H:%M:%S'),
+                "endpoint": endpoint,
+                "duration_ms": int(duration_ms)
+            })
+        except ValueError:
+            continue
+    return profiles
+
+@app.before_request
+def start_request_profile():
+    if not should_profile_request():
+        return
+    g.profile_start = time.perf_counter()
+    g.profile_sampler = StackSampler(threading.get_ident(), PROFILE_INTERVAL)
+    g.profile_sampler.start()
+
+@app.teardown_request
+def finish_request_profile(exc=None):
+    sampler = g.pop('profile_sampler', None)
+    if sampler is None:
+        return
+    sampler.stop()
+    duration_ms = int((time.perf_counter() - g.pop('profile_start')) * 1000)
+    if not sampler.stacks:
+        return # 샘플 주기보다 짧게 끝난 요청은 빈 프로파일을 남기지 않음
+    try:
+        save_profile(request.endpoint or "unknown", duration_ms, sampler.stacks)
+    except Exception as e:
+        print(f"프로파일 저장 오류: {e}")
+
 # Route for the free recommendation page (root URL)
 @app.route("/", methods=["GET", "POST"])
 def free():
@@ -292,7 +791,10 @@ def free():
 
 
     if request.method == "POST":
-        numbers = generate_numbers(count=1, exclude_ranks=['1', '2', '3'])
+        # 원클릭 추천은 count=1 고정의 가벼운 요청이므로 승인 제어 슬롯을 거치지 않습니다.
+        # (무거운 /filter 요청이 몰려도 이 경로의 지연이 늘어나지 않도록)
+        numbers = generate_numbers(count=1, exclude_ranks=['1', '2', '3'], unique_global=GLOBAL_UNIQUE_TICKETS)
+        archive_tickets(numbers)
         log_event("recommend", {
             "page": "index_premium_quick",
             "numbers": numbers,
@@ -346,19 +848,47 @@ def detailed_filter_page():
             user_include = parse_int_list(request.form.get("user_include", ""))
             count = int(request.form.get("count") or 5)
             
+            # 1~45 범위를 벗어난 제외 번호는 의미가 없으므로 무시합니다.
+            user_exclude = [n for n in user_exclude if 1 <= n <= 45]
+            
             if len(user_include) > 1:
                 error = "고정할 번호는 1개만 입력할 수 있습니다."
                 numbers = []
+            elif any(not 1 <= n <= 45 for n in user_include):
+                error = "고정할 번호는 1~45 사이여야 합니다."
+            elif not 1 <= count <= GENERATION_MAX_COUNT:
+                error = f"추천개수는 1~{GENERATION_MAX_COUNT}개까지 선택할 수 있습니다."
             else:
-                numbers = generate_numbers(
+                cost = estimate_generation_cost(
+                    count=count,
                     exclude_ranks=exclude_ranks,
-                    exclude_hot_n=exclude_hot_n, 
+                    exclude_hot_n=exclude_hot_n,
                     exclude_consecutive=exclude_consecutive,
                     user_exclude=user_exclude,
-                    user_include=user_include,
-                    count=count
+                    user_include=user_include
                 )
+                if cost is None:
+                    error = "조건에 맞는 추천번호가 없습니다. (필터를 줄이거나 다시 시도해주세요)"
+            
+            if not error:
+                admitted, error, status, retry_after, slot = admit_generation(cost)
+                if not admitted:
+                    form = dict(request.form)
+                    return render_template("filter.html", numbers=[], error=error, form=form), status, {"Retry-After": str(retry_after)}
+                try:
+                    numbers = generate_numbers(
+                        exclude_ranks=exclude_ranks,
+                        exclude_hot_n=exclude_hot_n, 
+                        exclude_consecutive=exclude_consecutive,
+                        user_exclude=user_exclude,
+                        user_include=user_include,
+                        count=count,
+                        unique_global=GLOBAL_UNIQUE_TICKETS
+                    )
+                finally:
+                    release_generation_slot(slot)
                 form = dict(request.form)
+                archive_tickets(numbers)
                 
                 if not numbers and not error:
                     error = "조건에 맞는 추천번호가 없습니다. (필터를 줄이거나 다시 시도해주세요)"
@@ -396,24 +926,59 @@ def hotpick_page():
 
     if request.method == "POST":
         try:
-            hot_pick_n = int(request.form.get("hot_pick_n") or 0) or None
+            hot_pick_raw = request.form.get("hot_pick_n") or ""
+            hot_pick_all = hot_pick_raw == "all" # 전체 회차 기준
+            hot_pick_n = None if hot_pick_all else int(hot_pick_raw or 0) or None
+            hot_pick_mode = request.form.get("hot_pick_mode") or "uniform"
             count = int(request.form.get("count") or 1)
+            if hot_pick_n and hot_pick_n >= len(rank1):
+                # 전체 회차 이상은 전체 회차와 같으므로 하나의 캐시 키로 모읍니다.
+                hot_pick_n, hot_pick_all = None, True
             
-            if hot_pick_n:
-                hot_numbers_set = get_hot_numbers(hot_pick_n)
+            if hot_pick_n is not None and hot_pick_n < 1:
+                error = "인기 번호 추천 주기가 올바르지 않습니다."
+            elif not 1 <= count <= GENERATION_MAX_COUNT:
+                error = f"추천개수는 1~{GENERATION_MAX_COUNT}개까지 선택할 수 있습니다."
+            elif hot_pick_mode not in HOT_PICK_MODES:
+                error = "지원하지 않는 인기 번호 추천 방식입니다."
+            elif hot_pick_n or hot_pick_all:
+                # 인기 번호 추출은 거절 루프가 없으므로 동시 실행 슬롯 없이 토큰만 차감합니다.
+                admitted, error, status, retry_after, slot = admit_generation(count, hold_slot=False)
+                if not admitted:
+                    form = dict(request.form)
+                    return render_template("hotpick.html", numbers=[], error=error, form=form), status, {"Retry-After": str(retry_after)}
                 
                 generated_numbers = []
-                for _ in range(count):
-                    if len(hot_numbers_set) < 6:
-                        error = "선택된 회차의 인기 번호가 6개 미만입니다. 다른 회차를 선택하거나 필터를 줄여주세요."
-                        break
-                    
-                    current_set = sorted(random.sample(list(hot_numbers_set), 6))
-                    generated_numbers.append(current_set)
+                if hot_pick_mode == "uniform":
+                    hot_numbers = get_hot_pick_table(hot_pick_n, "uniform")
+                    if len(hot_numbers) < 6:
+                        error = "선택된 회차의 인기 번호가 6개 미만입니다. 다른 회차를 선택하거나 가중치 추천 방식을 사용해주세요."
+                    draw = lambda: sorted(random.sample(hot_numbers, 6))
+                    pool_combos = math.comb(len(hot_numbers), 6)
+                else:
+                    # 출현 빈도(freq) 또는 최근 회차일수록 큰 가중치(decay)에 비례해 추첨
+                    table = get_hot_pick_table(hot_pick_n, hot_pick_mode)
+                    draw = lambda: weighted_hot_pick(table)
+                    pool_combos = math.comb(len(table[0]), 6)
+                
+                # 전역 중복 방지 모드에서는 이미 발급된 조합이면 다시 추첨합니다.
+                enforce_unique = GLOBAL_UNIQUE_TICKETS and pool_combos >= HOT_PICK_UNIQUE_MIN_COMBOS
+                if not error:
+                    for _ in range(count):
+                        ticket = draw_unique_ticket(draw) if enforce_unique else draw()
+                        if ticket is None:
+                            break
+                        generated_numbers.append(ticket)
+                    if not generated_numbers:
+                        error = "이번 회차에 발급되지 않은 인기 번호 조합을 찾지 못했습니다. 다른 회차나 추천 방식을 선택해주세요."
                 
                 if not error: 
                     numbers = generated_numbers
                     form = dict(request.form)
+                    archive_tickets(numbers)
+                    if GLOBAL_UNIQUE_TICKETS and not enforce_unique:
+                        # 조합 수가 너무 적은 풀은 거절하지 않지만, 다른 경로가 같은 조합을 다시 내지 않도록 기록합니다.
+                        mark_tickets_issued(numbers)
                     
                     log_event("recommend", {
                         "page": "hotpick_recommendation",
@@ -525,7 +1090,7 @@ def stats():
     log_event("visit", {"page": "stats"})
     recent_n = 10 
     numbers = []
-    for row in rank1[-recent_n:]:
+    for row in rank1[:recent_n]:
         numbers.extend(row)
     
     freq = dict(Counter(numbers))
@@ -539,8 +1104,8 @@ def stats():
 @app.route('/admin')
 def admin():
     pw = request.args.get("pw", "")
-    if pw != "1234":
-        return "관리자 인증 필요(pw=1234)", 403
+    if pw != ADMIN_PASSWORD:
+        return "관리자 인증 필요", 403
     
     logs = []
     if db: # db가 초기화되었을 때만 Firestore 사용
@@ -577,14 +1142,24 @@ def admin():
         if log["event"] == "recommend" and log.get("dt_formatted", "").startswith(today_str):
             today_recs_admin += 1
 
-    return render_template("admin.html", logs=logs, total_visits=total_visits, total_recs=total_recs, today_recs=today_recs_admin)
+    return render_template("admin.html", logs=logs, total_visits=total_visits, total_recs=total_recs, today_recs=today_recs_admin, profiles=list_profiles(), pw=pw)
+
+# Route to download a stored request profile (collapsed stack format)
+@app.route('/admin/profiles/<path:filename>')
+def admin_profile(filename):
+    pw = request.args.get("pw", "")
+    if pw != ADMIN_PASSWORD:
+        return "관리자 인증 필요", 403
+    if not filename.endswith(".folded"):
+        return "잘못된 프로파일 파일입니다.", 404
+    return send_from_directory(PROFILE_DIR, filename, mimetype="text/plain")
 
 # Route to update winning numbers (admin functionality)
 @app.route("/update_winning", methods=["POST"])
 def update_winning():
     pw = request.form.get("pw")
     
-    if pw != "1234":
+    if pw != ADMIN_PASSWORD:
         logs = []
         if db:
             try:
@@ -650,8 +1225,9 @@ def update_winning():
         print(f"{WINNING1_PATH} 파일 읽기/디코딩 에러 (새 파일 생성):", e)
         db_rank1 = {"rank1": []}
     
-    if nums not in db_rank1["rank1"]:
-        db_rank1["rank1"].append(nums)
+    is_new_round = nums not in db_rank1["rank1"]
+    if is_new_round:
+        db_rank1["rank1"].insert(0, nums) # 최신 회차를 맨 앞에 저장 (기존 파일 순서와 동일)
         with open(WINNING1_PATH, "w", encoding="utf-8") as f:
             json.dump(db_rank1, f, ensure_ascii=False, indent=2)
         msg_rank1 = f"{latest}회차 1등 번호 {nums} 저장 완료!"
@@ -696,6 +1272,21 @@ def update_winning():
     
     msg = f"{msg_rank1}<br>{msg_rank2}<br>{msg_rank3}"
 
+    # --- 이번 회차 발급 번호 당첨 집계 ---
+    if is_new_round:
+        if GLOBAL_UNIQUE_TICKETS:
+            try:
+                reset_issued_tickets()
+            except Exception as e:
+                print(f"발급 번호 비트맵 초기화 오류: {e}")
+        try:
+            tally = close_round_archive(latest, nums, bonus)
+            if tally:
+                msg += (f"<br>{latest}회차 발급 번호 {tally['total']}건 중 "
+                        f"1등 {tally['1']} / 2등 {tally['2']} / 3등 {tally['3']} / 4등 {tally['4']} / 5등 {tally['5']}")
+        except Exception as e:
+            print(f"발급 번호 당첨 집계 오류: {e}")
+
     global ALL_WINNING
     global rank1, rank2, rank3
     rank1 = load_rank(WINNING1_PATH, 'rank1', 6)
@@ -706,6 +1297,9 @@ def update_winning():
         "2": set(rank2),
         "3": set(rank3)
     }
+    # 새 회차가 반영되었으므로 인기 번호 alias 테이블을 무효화
+    with hot_pick_tables_lock:
+        hot_pick_tables.clear()
 
     logs = []
     if db: